@@ -1,24 +1,33 @@
 from flask import Flask, request
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from requests.adapters import HTTPAdapter
 import os
 from dotenv import load_dotenv
 import google.generativeai as genai
-from google.generativeai.types import Tool, FunctionDeclaration
-from google.generativeai.types import content_types as S
+from google.generativeai.types import Tool
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+import google_auth_httplib2
+import httplib2
 import datetime
 import pytz
 import json
 import time
 import threading
-from collections import defaultdict
+import heapq
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import re
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import execute_values
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
 from contextlib import contextmanager
+from functools import lru_cache
 from twilio.request_validator import RequestValidator
 
 load_dotenv()
@@ -34,37 +43,44 @@ os.makedirs('logs', exist_ok=True)
 logger = logging.getLogger('equilibrio_bot')
 logger.setLevel(logging.INFO)
 
-# Handler para archivo con rotación
-file_handler = RotatingFileHandler(
-    'logs/bot.log', 
-    maxBytes=10*1024*1024,  # 10MB
-    backupCount=5
-)
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-))
-
-# Handler para consola
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(levelname)s - %(message)s'
-))
-
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+# Evita handlers duplicados si el módulo se importa más de una vez
+if not logger.handlers:
+    # Handler para archivo con rotación
+    file_handler = RotatingFileHandler(
+        'logs/bot.log', 
+        maxBytes=10*1024*1024,  # 10MB
+        backupCount=5
+    )
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    ))
+    
+    # Handler para consola
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(levelname)s - %(message)s'
+    ))
+    
+    # Los handlers escriben desde un hilo aparte: el webhook solo encola el registro
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, file_handler, console_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
 
 # Logger específico para conversaciones
 conversation_logger = logging.getLogger('conversations')
 conversation_logger.setLevel(logging.INFO)
-conv_handler = RotatingFileHandler(
-    'logs/conversations.log',
-    maxBytes=10*1024*1024,
-    backupCount=10
-)
-conv_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(message)s'
-))
-conversation_logger.addHandler(conv_handler)
+if not conversation_logger.handlers:
+    conv_handler = RotatingFileHandler(
+        'logs/conversations.log',
+        maxBytes=10*1024*1024,
+        backupCount=10
+    )
+    conv_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(message)s'
+    ))
+    conversation_logger.addHandler(conv_handler)
 
 # ============================================
 # CONFIGURACIÓN BASE
@@ -76,12 +92,49 @@ TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
 validator = RequestValidator(TWILIO_AUTH_TOKEN)
 TWILIO_WHATSAPP_NUMBER = os.getenv('TWILIO_WHATSAPP_NUMBER')
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+# Cliente único con sesión HTTP persistente (keep-alive hacia api.twilio.com)
+twilio_client = Client(
+    TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN,
+    http_client=TwilioHttpClient(pool_connections=True)
+)
+# Pool de conexiones dimensionado para envíos concurrentes desde los workers;
+# los reintentos de urllib3 solo repiten fallas de conexión en POST
+twilio_client.http_client.session.mount('https://', HTTPAdapter(
+    pool_connections=1, pool_maxsize=32, max_retries=2
+))
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 CALENDAR_ID = os.getenv('CALENDAR_ID', '059bad589de3d4b2457841451a3939ba605411559b7728fc617765e69947b3e5@group.calendar.google.com')
 TZ = pytz.timezone('America/Santiago')
 
+# Horarios de atención por weekday (0=lunes ... 6=domingo)
+HOURS_BY_WEEKDAY = {1: (15, 19), 2: (10, 18), 3: (15, 19), 4: (10, 18), 5: (10, 13)}
+# Duración de cada cita (y de cada slot)
+APPOINTMENT_DURATION = datetime.timedelta(hours=1)
+APPOINTMENT_SECONDS = APPOINTMENT_DURATION.total_seconds()
+# Slots de 1 hora precomputados con su etiqueta: (hora, minuto, 'HH:MM')
+SLOTS_BY_WEEKDAY = {
+    weekday: tuple((hour, 0, f"{hour:02d}:00") for hour in range(opening, closing))
+    for weekday, (opening, closing) in HOURS_BY_WEEKDAY.items()
+}
+CLOSED_MESSAGES = {0: "❌ Cerrados los lunes", 6: "❌ Cerrados los domingos"}
+OUT_OF_HOURS_MESSAGES = {
+    1: "❌ Mar/Jue atendemos 15:00-19:00",
+    2: "❌ Mié/Vie atendemos 10:00-18:00",
+    3: "❌ Mar/Jue atendemos 15:00-19:00",
+    4: "❌ Mié/Vie atendemos 10:00-18:00",
+    5: "❌ Sábados 10:00-13:00",
+}
+# Resultado de validate_business_hours por (weekday, hora): mensaje de error o None
+_HOURS_ERRORS = {
+    (weekday, hour): (
+        CLOSED_MESSAGES[weekday] if weekday not in HOURS_BY_WEEKDAY
+        else None if HOURS_BY_WEEKDAY[weekday][0] <= hour < HOURS_BY_WEEKDAY[weekday][1]
+        else OUT_OF_HOURS_MESSAGES[weekday]
+    )
+    for weekday in range(7) for hour in range(24)
+}
+
 credentials_json = os.getenv('GOOGLE_SERVICE_ACCOUNT_JSON')
 if credentials_json:
     credentials_dict = json.loads(credentials_json)
@@ -91,6 +144,26 @@ if credentials_json:
 else:
     raise ValueError("ERROR: GOOGLE_SERVICE_ACCOUNT_JSON no configurado")
 
+# Servicio de Calendar construido una sola vez (discovery estático, sin red)
+CALENDAR_SERVICE = build(
+    'calendar', 'v3', credentials=credentials,
+    cache_discovery=False, static_discovery=True
+)
+
+# httplib2 no es thread-safe: cada hilo ejecuta con su propia conexión persistente
+_calendar_local = threading.local()
+CALENDAR_HTTP_TIMEOUT = 15  # segundos; sin timeout un socket colgado bloquea al hilo indefinidamente
+
+def get_calendar_http():
+    """Conexión HTTP autorizada del hilo actual para ejecutar requests de Calendar"""
+    http = getattr(_calendar_local, 'http', None)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(
+            credentials, http=httplib2.Http(timeout=CALENDAR_HTTP_TIMEOUT)
+        )
+        _calendar_local.http = http
+    return http
+
 # ============================================
 # GESTIÓN DE BASE DE DATOS (PostgreSQL/Supabase)
 # ============================================
@@ -102,91 +175,330 @@ if not DATABASE_URL:
 if not CLIENT_ID:
     raise ValueError("ERROR: CLIENT_ID no configurado")
 
+# Pool de conexiones: LIFO para reutilizar la conexión más caliente; None = aún no abierta
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = 30  # segundos máximos esperando una conexión libre
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+for _ in range(DB_POOL_SIZE):
+    _db_pool.put(None)
+
+# Serializador JSON compacto y sin escapes \uXXXX: un solo encoder reutilizado,
+# menos bytes en la BD y menos tokens en el prompt
+_json_dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+# Caché write-through de lecturas por teléfono (historial y contexto)
+CONVERSATION_CACHE_TTL = 30  # segundos
+_HISTORY_CACHE = {}  # phone -> (expira, limit consultado, [(direction, content), ...])
+_CONTEXT_CACHE = {}  # phone -> (expira, context_json)
+_CONVERSATION_CACHE_LOCK = threading.Lock()
+
 @contextmanager
 def get_db():
-    """Context manager para conexión a Supabase (PostgreSQL)"""
-    conn = psycopg2.connect(DATABASE_URL)
+    """Context manager para conexión a Supabase (PostgreSQL) tomada del pool"""
+    conn = _db_pool.get(timeout=DB_POOL_TIMEOUT)
     try:
-        yield conn
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error en transacción BD: {e}")
-        raise
+        if conn is None or conn.closed:
+            conn = psycopg2.connect(
+                DATABASE_URL, keepalives=1, keepalives_idle=30,
+                keepalives_interval=10, keepalives_count=3
+            )
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    conn.close()  # Conexión rota: se reabre en el próximo uso
+            logger.error(f"Error en transacción BD: {e}")
+            raise
     finally:
-        conn.close()
+        _db_pool.put(conn)
 
-def save_message(phone, direction, content, intent=None):
-    """Guarda mensaje en BD con client_id"""
+def close_db_pool():
+    """Cierra las conexiones inactivas del pool al apagar, para que Supabase
+    libere sus backends de inmediato en lugar de esperar al timeout TCP"""
+    while True:
+        try:
+            conn = _db_pool.get_nowait()
+        except queue.Empty:
+            break
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+atexit.register(close_db_pool)
+
+# Índices para las consultas del camino caliente; (nombre, definición) para
+# poder detectar builds inválidos por nombre
+DB_INDEXES = (
+    ('messages_client_phone_ts_idx', 'ON messages (client_id, phone_number, timestamp DESC)'),
+    ('appointments_client_phone_idx', 'ON appointments (client_id, phone_number)'),
+)
+DB_CONNECT_TIMEOUT = 10  # segundos
+
+_SQL_INDEX_VALID = '''
+    SELECT i.indisvalid
+    FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = %s
+'''
+
+def ensure_db_indexes():
+    """Crea los índices faltantes sin bloquear escrituras (CONCURRENTLY requiere
+    autocommit). Un build CONCURRENTLY interrumpido deja el índice INVALID y
+    IF NOT EXISTS lo saltaría para siempre: se elimina y se vuelve a crear"""
     try:
-        with get_db() as conn:
+        conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT)
+        try:
+            conn.autocommit = True
             cursor = conn.cursor()
-            # Primero obtiene o crea la conversación
-            cursor.execute('''
-                INSERT INTO conversations (client_id, phone_number, last_message_at)
-                VALUES (%s, %s, NOW())
-                ON CONFLICT (client_id, phone_number) 
-                DO UPDATE SET last_message_at = NOW()
-                RETURNING id
-            ''', (CLIENT_ID, phone))
-            
-            conversation_id = cursor.fetchone()[0]
-            
-            # Guarda el mensaje
-            cursor.execute('''
-                INSERT INTO messages (conversation_id, client_id, phone_number, direction, content, intent)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (conversation_id, CLIENT_ID, phone, direction, content, intent))
+            for name, definition in DB_INDEXES:
+                cursor.execute(_SQL_INDEX_VALID, (name,))
+                row = cursor.fetchone()
+                if row and row[0]:
+                    continue
+                if row:
+                    logger.warning(f"Índice inválido, reconstruyendo: {name}")
+                    cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+                cursor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}')
+                logger.info(f"Índice creado: {name}")
+        finally:
+            conn.close()
     except Exception as e:
-        logger.error(f"Error guardando mensaje: {e}")
+        logger.warning(f"No se pudieron verificar índices: {e}")
+
+# En segundo plano: un build largo o una BD inalcanzable no frenan el arranque
+# del worker ni lo exponen al --timeout de gunicorn
+threading.Thread(target=ensure_db_indexes, name='db-indexes', daemon=True).start()
+
+# Sentencias SQL fijas: se arman una sola vez al cargar el módulo
+_SQL_ASYNC_COMMIT = 'SET LOCAL synchronous_commit TO OFF'
+_SQL_UPSERT_CONVERSATION = '''
+    INSERT INTO conversations (client_id, phone_number, last_message_at)
+    VALUES (%s, %s, NOW())
+    ON CONFLICT (client_id, phone_number)
+    DO UPDATE SET last_message_at = NOW()
+    RETURNING id
+'''
+# timestamp explícito con clock_timestamp(): avanza fila a fila, así entrante y
+# respuesta escritos en la misma transacción no empatan (now() es el inicio de la
+# transacción) y el historial conserva su orden
+_SQL_INSERT_MESSAGES = '''
+    INSERT INTO messages (conversation_id, client_id, phone_number, direction, content, intent, timestamp)
+    VALUES %s
+'''
+_SQL_INSERT_MESSAGES_TEMPLATE = '(%s, %s, %s, %s, %s, %s, clock_timestamp())'
+# Últimos N por índice (DESC) y devueltos ya en orden cronológico
+_SQL_SELECT_HISTORY = '''
+    SELECT direction, content FROM (
+        SELECT direction, content, timestamp
+        FROM messages
+        WHERE phone_number = %s AND client_id = %s
+        ORDER BY timestamp DESC
+        LIMIT %s
+    ) recent
+    ORDER BY timestamp ASC
+'''
+_SQL_UPSERT_STATE = '''
+    INSERT INTO conversations (client_id, phone_number, state, context, last_message_at)
+    VALUES (%s, %s, %s, %s, NOW())
+    ON CONFLICT (client_id, phone_number) DO UPDATE SET
+        state = EXCLUDED.state,
+        context = EXCLUDED.context,
+        last_message_at = NOW()
+'''
+_SQL_SELECT_CONTEXT = 'SELECT context::text FROM conversations WHERE phone_number = %s AND client_id = %s'
+_SQL_UPSERT_PENDING = '''
+    INSERT INTO pending_confirmations (client_id, phone_number, appointment_data, expires_at)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (client_id, phone_number) DO UPDATE SET
+        appointment_data = EXCLUDED.appointment_data,
+        expires_at = EXCLUDED.expires_at
+'''
+_SQL_SELECT_PENDING = '''
+    SELECT appointment_data::text
+    FROM pending_confirmations
+    WHERE phone_number = %s AND client_id = %s AND expires_at > NOW()
+'''
+_SQL_DELETE_PENDING = 'DELETE FROM pending_confirmations WHERE phone_number = %s AND client_id = %s'
+_SQL_PURGE_PENDING = 'DELETE FROM pending_confirmations WHERE client_id = %s AND expires_at <= NOW()'
+_SQL_INSERT_APPOINTMENT = '''
+    INSERT INTO appointments (client_id, conversation_id, phone_number, patient_name, contact_info, appointment_time, google_event_id)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+'''
+_SQL_STATS = '''
+    SELECT
+        (SELECT COUNT(*) FROM conversations WHERE client_id = %(client_id)s),
+        (SELECT COUNT(*) FROM messages WHERE client_id = %(client_id)s),
+        (SELECT COUNT(*) FROM appointments WHERE client_id = %(client_id)s)
+'''
+
+def save_messages_batch(conn, phone, rows):
+    """Guarda varios mensajes (direction, content, intent) de un teléfono dentro
+    de la transacción de conn: un upsert de conversación y un solo INSERT multi-fila"""
+    cursor = conn.cursor()
+    # Log de mensajes: el commit no espera el flush del WAL en el servidor
+    cursor.execute(_SQL_ASYNC_COMMIT)
+    # Primero obtiene o crea la conversación
+    cursor.execute(_SQL_UPSERT_CONVERSATION, (CLIENT_ID, phone))
+    conversation_id = cursor.fetchone()[0]
+    
+    execute_values(cursor, _SQL_INSERT_MESSAGES, [
+        (conversation_id, CLIENT_ID, phone, direction, content, intent)
+        for direction, content, intent in rows
+    ], template=_SQL_INSERT_MESSAGES_TEMPLATE)
+
+def _append_history_cache(phone, rows):
+    """Mantiene el historial cacheado al día en lugar de invalidarlo"""
+    with _CONVERSATION_CACHE_LOCK:
+        entry = _HISTORY_CACHE.get(phone)
+        if entry:
+            expires, limit, messages = entry
+            messages = messages + [(direction, content) for direction, content, _ in rows]
+            _HISTORY_CACHE[phone] = (expires, limit, messages[-limit:])
+
+# Escritor de mensajes en segundo plano: el log de conversación no necesita
+# durabilidad inmediata, así que sale del camino de la respuesta y se agrupa
+MESSAGE_WRITE_BATCH = 200  # lotes (phone, rows) máximos por transacción
+MESSAGE_WRITE_WAIT = 0.05  # segundos esperando más lotes antes de escribir
+MESSAGE_WRITER_JOIN_TIMEOUT = 10  # segundos esperando al escritor al apagar
+_MESSAGE_WRITE_QUEUE = queue.Queue(maxsize=10000)
+_MESSAGE_WRITER_STOP = object()  # centinela: el escritor vacía lo pendiente y termina
+
+def _write_message_batches(batches):
+    """Escribe lotes (phone, rows) en una sola transacción; si falla, reintenta
+    cada teléfono en su propia transacción para no perder los demás"""
+    by_phone = {}
+    for phone, rows in batches:
+        by_phone.setdefault(phone, []).extend(rows)
+    try:
+        with get_db() as conn:
+            for phone, rows in by_phone.items():
+                save_messages_batch(conn, phone, rows)
+        return
+    except Exception as e:
+        logger.error(f"Error guardando mensajes, reintentando por teléfono: {e}")
+    for phone, rows in by_phone.items():
+        try:
+            with get_db() as conn:
+                save_messages_batch(conn, phone, rows)
+        except Exception as e:
+            logger.error(f"Error guardando mensajes de {phone}: {e}")
+
+def queue_messages(phone, rows):
+    """Encola mensajes (direction, content, intent) para el escritor; el historial
+    cacheado se actualiza ya. Si la cola está llena, escribe en el momento"""
+    _append_history_cache(phone, rows)
+    if not _MESSAGE_WRITER.is_alive():
+        _write_message_batches([(phone, rows)])
+        return
+    try:
+        _MESSAGE_WRITE_QUEUE.put_nowait((phone, rows))
+    except queue.Full:
+        _write_message_batches([(phone, rows)])
+
+def _message_writer():
+    """Vacía la cola de mensajes: hasta MESSAGE_WRITE_BATCH lotes o MESSAGE_WRITE_WAIT
+    segundos. Termina al recibir _MESSAGE_WRITER_STOP, tras escribir lo ya reunido"""
+    while True:
+        item = _MESSAGE_WRITE_QUEUE.get()
+        if item is _MESSAGE_WRITER_STOP:
+            return
+        batches = [item]
+        stop = False
+        deadline = time.time() + MESSAGE_WRITE_WAIT
+        while len(batches) < MESSAGE_WRITE_BATCH:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = _MESSAGE_WRITE_QUEUE.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _MESSAGE_WRITER_STOP:
+                stop = True
+                break
+            batches.append(item)
+        _write_message_batches(batches)
+        if stop:
+            return
 
-def get_conversation_history(phone, limit=10):
-    """Obtiene historial de conversación desde BD"""
+def stop_message_writer():
+    """Al apagar: el centinela va detrás de lo encolado, así que el escritor lo
+    escribe todo antes de terminar; se espera a que acabe"""
+    try:
+        _MESSAGE_WRITE_QUEUE.put(_MESSAGE_WRITER_STOP, timeout=MESSAGE_WRITER_JOIN_TIMEOUT)
+    except queue.Full:
+        logger.error("Cola de mensajes llena al apagar: no se pudo detener el escritor")
+        return
+    _MESSAGE_WRITER.join(timeout=MESSAGE_WRITER_JOIN_TIMEOUT)
+
+_MESSAGE_WRITER = threading.Thread(target=_message_writer, name='message-writer', daemon=True)
+_MESSAGE_WRITER.start()
+# atexit corre en orden inverso: esto se ejecuta antes de close_db_pool
+atexit.register(stop_message_writer)
+
+def get_recent_messages(phone, limit=10):
+    """Obtiene los últimos mensajes como (direction, content), en orden cronológico"""
+    with _CONVERSATION_CACHE_LOCK:
+        entry = _HISTORY_CACHE.get(phone)
+    if entry and entry[0] > time.time() and limit <= entry[1]:
+        return entry[2][-limit:]
+    
     with get_db() as conn:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute('''
-            SELECT content, direction, timestamp 
-            FROM messages 
-            WHERE phone_number = %s AND client_id = %s
-            ORDER BY timestamp DESC 
-            LIMIT %s
-        ''', (phone, CLIENT_ID, limit))
-        
-        messages = cursor.fetchall()
-        
-    # Invierte para mostrar cronológicamente
-    history = []
-    for msg in reversed(messages):
-        prefix = "Usuario" if msg['direction'] == 'incoming' else "Bot"
-        history.append(f"{prefix}: {msg['content']}")
+        cursor = conn.cursor()
+        cursor.execute(_SQL_SELECT_HISTORY, (phone, CLIENT_ID, limit))
+        result = cursor.fetchall()
     
-    return '\n'.join(history)
+    with _CONVERSATION_CACHE_LOCK:
+        _HISTORY_CACHE[phone] = (time.time() + CONVERSATION_CACHE_TTL, limit, result)
+    return result[:]
+
+def format_history(messages):
+    """Formatea mensajes (direction, content) como historial para el prompt"""
+    return '\n'.join(
+        ("Usuario: " if direction == 'incoming' else "Bot: ") + content
+        for direction, content in messages
+    )
 
 def update_conversation_state(phone, state, context=None):
-    """Actualiza estado de conversación"""
+    """Actualiza estado de conversación; devuelve el contexto tal como se guardó"""
+    context_json = _json_dumps(context) if context else None
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO conversations (client_id, phone_number, state, context, last_message_at)
-            VALUES (%s, %s, %s, %s, NOW())
-            ON CONFLICT (client_id, phone_number) DO UPDATE SET
-                state = EXCLUDED.state,
-                context = EXCLUDED.context,
-                last_message_at = NOW()
-        ''', (CLIENT_ID, phone, state, json.dumps(context) if context else None))
-
-def get_conversation_context(phone):
-    """Obtiene contexto de conversación"""
+        cursor.execute(_SQL_UPSERT_STATE, (CLIENT_ID, phone, state, context_json))
+    
+    with _CONVERSATION_CACHE_LOCK:
+        _CONTEXT_CACHE[phone] = (time.time() + CONVERSATION_CACHE_TTL, context_json)
+    return context_json
+
+def get_conversation_context_json(phone):
+    """Obtiene contexto de conversación ya serializado, tal como está guardado"""
+    with _CONVERSATION_CACHE_LOCK:
+        entry = _CONTEXT_CACHE.get(phone)
+    if entry and entry[0] > time.time():
+        return entry[1]
+    
     with get_db() as conn:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            'SELECT context FROM conversations WHERE phone_number = %s AND client_id = %s',
-            (phone, CLIENT_ID)
-        )
+        cursor = conn.cursor()
+        cursor.execute(_SQL_SELECT_CONTEXT, (phone, CLIENT_ID))
         row = cursor.fetchone()
-        if row and row['context']:
-            return json.loads(row['context'])
-    return {}
+        context_json = row[0] if row and row[0] else None
+    
+    with _CONVERSATION_CACHE_LOCK:
+        _CONTEXT_CACHE[phone] = (time.time() + CONVERSATION_CACHE_TTL, context_json)
+    return context_json
+
+def purge_conversation_cache():
+    """Descarta entradas vencidas de la caché de historial y contexto"""
+    now = time.time()
+    with _CONVERSATION_CACHE_LOCK:
+        for cache in (_HISTORY_CACHE, _CONTEXT_CACHE):
+            for phone in [p for p, entry in cache.items() if entry[0] <= now]:
+                del cache[phone]
 
 def save_pending_confirmation(phone, appointment_data):
     """Guarda cita pendiente de confirmación"""
@@ -194,92 +506,194 @@ def save_pending_confirmation(phone, appointment_data):
     
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO pending_confirmations (client_id, phone_number, appointment_data, expires_at)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (client_id, phone_number) DO UPDATE SET
-                appointment_data = EXCLUDED.appointment_data,
-                expires_at = EXCLUDED.expires_at
-        ''', (CLIENT_ID, phone, json.dumps(appointment_data), expires_at))
+        cursor.execute(_SQL_UPSERT_PENDING, (CLIENT_ID, phone, _json_dumps(appointment_data), expires_at))
     
     logger.info(f"Confirmación guardada para {phone}")
 
-def get_pending_confirmation(phone):
-    """Obtiene cita pendiente de confirmación"""
+def get_pending_confirmation_json(phone):
+    """Obtiene cita pendiente de confirmación ya serializada (texto JSON)"""
     with get_db() as conn:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute('''
-            SELECT appointment_data 
-            FROM pending_confirmations 
-            WHERE phone_number = %s AND client_id = %s AND expires_at > NOW()
-        ''', (phone, CLIENT_ID))
+        cursor = conn.cursor()
+        cursor.execute(_SQL_SELECT_PENDING, (phone, CLIENT_ID))
         
         row = cursor.fetchone()
         if row:
-            data = row['appointment_data']
-            # Si ya es dict, devolver directo; si es string, parsear
-            return data if isinstance(data, dict) else json.loads(data)
+            return row[0]
     return None
 
 def clear_pending_confirmation(phone):
     """Limpia confirmación pendiente"""
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute(
-            'DELETE FROM pending_confirmations WHERE phone_number = %s AND client_id = %s',
-            (phone, CLIENT_ID)
-        )
+        cursor.execute(_SQL_DELETE_PENDING, (phone, CLIENT_ID))
+
+def purge_expired_confirmations():
+    """Elimina confirmaciones vencidas para mantener la tabla pequeña"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(_SQL_PURGE_PENDING, (CLIENT_ID,))
 
 def save_appointment(phone, name, contact, appointment_time, event_id=None):
     """Guarda cita en BD"""
     with get_db() as conn:
         cursor = conn.cursor()
         
-        # Obtener conversation_id (para vincular profesionalmente)
-        cursor.execute('''
-            SELECT id FROM conversations 
-            WHERE client_id = %s AND phone_number = %s
-        ''', (CLIENT_ID, phone))
-        row = cursor.fetchone()
-        conversation_id = row[0] if row else None  # NULL si no existe (permitido)
-        if not conversation_id:
-            logger.warning(f"No se encontró conversación para {phone}, usando conversation_id=NULL")
+        # Obtener o crear conversation_id (para vincular profesionalmente): los
+        # mensajes del turno se guardan recién después de generar la respuesta
+        cursor.execute(_SQL_UPSERT_CONVERSATION, (CLIENT_ID, phone))
+        conversation_id = cursor.fetchone()[0]
         
         # INSERT original (ya profesional) + conversation_id
-        cursor.execute('''
-            INSERT INTO appointments (client_id, conversation_id, phone_number, patient_name, contact_info, appointment_time, google_event_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ''', (CLIENT_ID, conversation_id, phone, name, contact, appointment_time, event_id))
+        cursor.execute(_SQL_INSERT_APPOINTMENT, (CLIENT_ID, conversation_id, phone, name, contact, appointment_time, event_id))
+
+# El registro de la cita en BD no condiciona la respuesta: Calendar ya es la
+# fuente de verdad cuando se llega aquí, así que se escribe en segundo plano
+_APPOINTMENT_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='appointment-db')
+
+def _save_appointment_logged(phone, name, contact, appointment_time, event_id):
+    """save_appointment para el pool de fondo: los errores quedan en el log"""
+    try:
+        save_appointment(phone, name, contact, appointment_time, event_id)
+    except Exception as e:
+        logger.error(f"Error guardando cita {event_id} en BD: {e}")
+
+def save_appointment_async(phone, name, contact, appointment_time, event_id=None):
+    """Encola el registro de la cita en BD sin esperar la escritura"""
+    _APPOINTMENT_EXECUTOR.submit(_save_appointment_logged, phone, name, contact, appointment_time, event_id)
 
 # ============================================
 # BUFFER DE MENSAJES (agrupamiento inteligente)
 # ============================================
-MESSAGE_BUFFER = defaultdict(lambda: {
-    'messages': [],
-    'timer': None,
-    'lock': threading.Lock(),
-    'last_activity': time.time()
-})
+# Sesiones por teléfono; se crean explícitamente en touch_session bajo _BUFFER_LOCK
+MESSAGE_BUFFER = {}
+_BUFFER_LOCK = threading.Lock()
 
 BUFFER_DELAY = 8  # segundos de espera
+# Hilos que procesan mensajes agrupados; el trabajo es I/O (Gemini, Calendar, BD)
+BUFFER_WORKERS = int(os.getenv('BUFFER_WORKERS', 16))
+
+# Un único hilo barredor con un heap de (deadline, phone) reemplaza un
+# threading.Timer por mensaje; el procesamiento corre en un pool acotado.
+# Cada sesión tiene a lo sumo una entrada en el heap ('scheduled'): una ráfaga
+# de mensajes solo corre su deadline, y el barredor la re-encola si hace falta.
+_BUFFER_HEAP = []
+_BUFFER_HEAP_LOCK = threading.Lock()
+_BUFFER_NOTIFY = threading.Event()
+_BUFFER_EXECUTOR = ThreadPoolExecutor(max_workers=BUFFER_WORKERS, thread_name_prefix='buffer')
+
+def schedule_buffer_flush(from_phone, session):
+    """Agenda el procesamiento del buffer tras BUFFER_DELAY, si no está ya agendado"""
+    with _BUFFER_HEAP_LOCK:
+        if session['scheduled']:
+            return
+        session['scheduled'] = True
+        heapq.heappush(_BUFFER_HEAP, (session['last_activity'] + BUFFER_DELAY, from_phone))
+    _BUFFER_NOTIFY.set()
+
+def _buffer_sweeper():
+    """Despacha los buffers vencidos; si la sesión tuvo actividad después de
+    agendarse, re-encola su entrada con el deadline corrido"""
+    while True:
+        due = []
+        with _BUFFER_HEAP_LOCK:
+            now = time.time()
+            while _BUFFER_HEAP and _BUFFER_HEAP[0][0] <= now:
+                phone = heapq.heappop(_BUFFER_HEAP)[1]
+                session = MESSAGE_BUFFER.get(phone)
+                if session is None:
+                    continue
+                deadline = session['last_activity'] + BUFFER_DELAY
+                if deadline > now:
+                    heapq.heappush(_BUFFER_HEAP, (deadline, phone))
+                else:
+                    session['scheduled'] = False
+                    due.append(phone)
+            timeout = _BUFFER_HEAP[0][0] - now if _BUFFER_HEAP else None
+            _BUFFER_NOTIFY.clear()
+
+        for phone in due:
+            _BUFFER_EXECUTOR.submit(process_buffered_messages, phone)
+
+        _BUFFER_NOTIFY.wait(timeout=timeout)
+
+threading.Thread(target=_buffer_sweeper, name='buffer-sweeper', daemon=True).start()
+
+def flush_pending_buffers():
+    """Al apagar: despacha los buffers que siguen dentro de su ventana de espera"""
+    with _BUFFER_LOCK:
+        pending = [phone for phone, session in MESSAGE_BUFFER.items() if session['messages']]
+    for phone in pending:
+        _BUFFER_EXECUTOR.submit(process_buffered_messages, phone)
+    if pending:
+        logger.info(f"Procesando {len(pending)} buffers pendientes al apagar")
+
+# El executor deja de aceptar trabajo en el cierre de threading, antes que atexit;
+# registrado ahí después de él, esto corre primero y su cierre espera lo despachado.
+# Luego atexit detiene el escritor de mensajes y cierra el pool de BD.
+getattr(threading, '_register_atexit', atexit.register)(flush_pending_buffers)
+
+SESSION_CLEANUP_TIME = 30 * 60  # segundos de inactividad antes de limpiar
+SESSION_CLEANUP_INTERVAL = 60  # segundos entre barridos
+
+# Orden de actividad de las sesiones: la menos reciente queda al frente.
+# _BUFFER_LOCK protege el mapa y este orden; el 'lock' de cada sesión, sus mensajes.
+_SESSION_ORDER = OrderedDict()
+
+def touch_session(phone):
+    """Obtiene (o crea) la sesión del teléfono y la marca como la más reciente"""
+    with _BUFFER_LOCK:
+        session = MESSAGE_BUFFER.get(phone)
+        if session is None:
+            session = MESSAGE_BUFFER[phone] = {
+                'messages': [],
+                'lock': threading.Lock(),
+                'last_activity': 0,
+                'scheduled': False
+            }
+        session['last_activity'] = time.time()
+        _SESSION_ORDER[phone] = None
+        _SESSION_ORDER.move_to_end(phone)
+    return session
 
 def cleanup_old_sessions():
-    """Limpia sesiones inactivas > 30 min"""
-    now = time.time()
-    timeout = 30 * 60
-    to_remove = [
-        phone for phone, session in MESSAGE_BUFFER.items()
-        if now - session['last_activity'] > timeout
-    ]
-    for phone in to_remove:
-        if MESSAGE_BUFFER[phone]['timer']:
-            MESSAGE_BUFFER[phone]['timer'].cancel()
-        del MESSAGE_BUFFER[phone]
+    """Limpia sesiones inactivas > 30 min, desde la menos reciente hasta la primera viva"""
+    cutoff = time.time() - SESSION_CLEANUP_TIME
+    removed = []
+    with _BUFFER_LOCK:
+        while _SESSION_ORDER:
+            phone = next(iter(_SESSION_ORDER))
+            session = MESSAGE_BUFFER.get(phone)
+            if session and session['last_activity'] >= cutoff:
+                break
+            del _SESSION_ORDER[phone]
+            MESSAGE_BUFFER.pop(phone, None)
+            removed.append(phone)
+    
+    # Log fuera del lock para no demorar a los webhooks que esperan touch_session
+    for phone in removed:
         logger.info(f"Sesión limpiada: {phone}")
 
+def _session_cleanup_loop():
+    """Barre sesiones inactivas periódicamente, fuera del webhook"""
+    while True:
+        time.sleep(SESSION_CLEANUP_INTERVAL)
+        try:
+            cleanup_old_sessions()
+        except Exception as e:
+            logger.error(f"Error limpiando sesiones: {e}")
+        try:
+            purge_expired_confirmations()
+        except Exception as e:
+            logger.error(f"Error limpiando confirmaciones vencidas: {e}")
+        purge_conversation_cache()
+
+threading.Thread(target=_session_cleanup_loop, name='session-cleanup', daemon=True).start()
+
 def process_buffered_messages(from_phone):
     """Procesa mensajes agrupados"""
-    session = MESSAGE_BUFFER[from_phone]
+    session = MESSAGE_BUFFER.get(from_phone)
+    if session is None:
+        return
     
     with session['lock']:
         if not session['messages']:
@@ -287,21 +701,18 @@ def process_buffered_messages(from_phone):
         
         combined_message = '\n'.join(session['messages'])
         session['messages'].clear()
-        session['timer'] = None
     
     logger.info(f"📦 Procesando {len(session['messages'])} mensajes de {from_phone}")
     
-    # Guarda mensaje entrante
-    save_message(from_phone, 'incoming', combined_message)
-    
     # Log conversacional
     conversation_logger.info(f"USER ({from_phone}): {combined_message}")
     
-    # Genera respuesta
+    # Genera respuesta (el mensaje entrante ya va aparte en el prompt)
     response = generate_response(combined_message, from_phone)
     
-    # Guarda respuesta
-    save_message(from_phone, 'outgoing', response)
+    # Entrante y respuesta van juntos al escritor en segundo plano: el envío
+    # por Twilio no espera a la BD
+    queue_messages(from_phone, [('incoming', combined_message, None), ('outgoing', response, None)])
     conversation_logger.info(f"BOT: {response}")
     
     # Envía por Twilio
@@ -381,34 +792,41 @@ book_multiple_appointments_tool = {
 appointment_tools = Tool(
     function_declarations=[book_single_appointment_tool, book_multiple_appointments_tool]
 )
+
 # ============================================
 # MODELO GEMINI 2.5 CON PROMPT MEJORADO
 # ============================================
 
-def generate_response(user_message, from_phone):
-    """
-    Genera respuesta usando Gemini 2.5 Flash con prompt optimizado
-    """
-    try:
-        # Obtener contexto conversacional
-        history = get_conversation_history(from_phone, limit=15)
-        context = get_conversation_context(from_phone)
-        
-        # Verificar si hay confirmación pendiente
-        pending = get_pending_confirmation(from_phone)
-        
-        # Verificar disponibilidad de horarios para hoy/mañana
-        available_today = get_available_slots(datetime.datetime.now(TZ))
-        available_tomorrow = get_available_slots(datetime.datetime.now(TZ) + datetime.timedelta(days=1))
+# Expresiones regulares precompiladas
+_PREFERENCES_RE = re.compile(r'\b(no|no quiero|diferentes|cada \d+ d[ií]as|semanal|mensual)\b', re.IGNORECASE)
+# Confirmación por palabras completas: una afirmativa y ninguna de rechazo o cambio
+_WORD_RE = re.compile(r'\w+')
+_CONFIRM_WORDS = frozenset({'si', 'sí', 'confirmo', 'dale', 'ok', 'okay', 'correcto'})
+_DECLINE_WORDS = frozenset({'cancelar', 'cancela', 'cambiar', 'cambia', 'modificar'})
+_NAME_RE = re.compile(r'Nombre:\s*([^\n]+)')
+_DATE_RE = re.compile(r'Fecha:\s*([^\n]+)')
+_TIME_RE = re.compile(r'Hora:\s*(\d{1,2}:\d{2})')
+_CONTACT_RE = re.compile(r'(?:Teléfono|Email):\s*([^\n]+)')
+_DDMMYYYY_RE = re.compile(r'(\d{2})/(\d{2})/(\d{4})')
+_EMAIL_RE = re.compile(r'^[\w\.-]+@[\w\.-]+\.\w+$')
+_BOOK_JSON_RE = re.compile(r'\{[^{}]*"action"\s*:\s*"book_appointment"[^{}]*\}', re.DOTALL)
+
+# Tablas de traducción para normalizar en una sola pasada
+_STRIP_CONTACT = str.maketrans('', '', '+ -')
+_TIME_FIX = str.maketrans({'.': ':', ' ': None})
+
+def is_confirmation(message):
+    """El usuario confirma si usa una palabra afirmativa, ninguna de cancelar o
+    cambiar, y no arranca con "no" ("no, sí prefiero el martes" no confirma;
+    "sí, no hay problema" sí)"""
+    tokens = _WORD_RE.findall(message.lower())
+    if not tokens or tokens[0] == 'no':
+        return False
+    words = set(tokens)
+    return not words.isdisjoint(_CONFIRM_WORDS) and words.isdisjoint(_DECLINE_WORDS)
 
-        # Detectar rechazos o preferencias en mensaje
-        if re.search(r'\b(no|no quiero|diferentes|cada \d+ d[ií]as|semanal|mensual)\b', user_message.lower()):
-            context['state'] = 'asking_preferences'  # Marca estado para que prompt sepa
-            context['user_preferences'] = user_message  # Guarda lo que dijo
-            update_conversation_state(from_phone, 'asking_preferences', context)
-        
-        # PROMPT MEJORADO CON EJEMPLOS REALES (Cambio: Modificado para usar herramientas en lugar de JSON)
-        system_prompt = f"""Eres el asistente virtual de EQUILIBRIO, centro quiropráctico especializado en el Método Equilibrio.
+# Partes estáticas del prompt (se construyen una sola vez al importar)
+_SYSTEM_PROMPT_HEAD = """Eres el asistente virtual de EQUILIBRIO, centro quiropráctico especializado en el Método Equilibrio.
 
 🎯 TU MISIÓN: 
 - Responder consultas sobre precios, servicios y horarios
@@ -463,7 +881,7 @@ Ejemplo:
 
 ¿Confirmas para agendar? (Responde Sí o No)"
 
-PASO 5: SOLO si confirma, responde con el JSON de agendamiento
+PASO 5: SOLO si confirma, llama a la herramienta de agendamiento (nunca escribas JSON en el texto)
 
 🤖 Manejo de Frecuencias y Paquetes:
 - Si el usuario pide X sesiones con restricciones (e.g., "2 por semana", "esta semana y próxima"), calcula fechas distribuidas lógicamente:
@@ -495,15 +913,9 @@ Si detectas alguna de estas condiciones, NO intentes agendar directamente:
 En estos casos, responde:
 "Por tu condición, es importante que hables directamente con nuestro quiropráctico para evaluar tu caso. Te recomiendo llamar al +56 9 7533 2088 para coordinar una evaluación personalizada."
 
-📊 DISPONIBILIDAD ACTUAL:
-- Próximos 7 días: {json.dumps(get_available_slots_in_range(datetime.datetime.now(TZ), datetime.datetime.now(TZ) + datetime.timedelta(days=7)))}
-- Próximos 30 días: Resume disponibles (usa rangos para multi-sesiones, ej. 'Miércoles disponibles: 5/11, 12/11, 19/11, 26/11').
-
-📝 HISTORIAL: {history}
-💾 CONTEXTO: {json.dumps(context)}
-⏳ PENDIENTE: {json.dumps(pending)}
+"""
 
-🎨 TONO Y ESTILO:
+_SYSTEM_PROMPT_RULES = """🎨 TONO Y ESTILO:
 - Amigable y cercano, usando emojis moderadamente
 - Profesional pero no robótico
 - Respuestas cortas y claras (máximo 3-4 líneas por respuesta)
@@ -527,21 +939,24 @@ PASO 3: SOLO SI EL USUARIO CONFIRMA ("Sí", "Confirmo", "Dale"), usarás una her
 -   **Para varias citas (ej: "Quiero 4 sesiones"):** Debes primero encontrar 4 horarios disponibles (ej: "Miércoles 10:00, Jueves 11:00..."), mostrarlos al usuario, y si confirma, llamar a la herramienta `book_multiple_appointments` con la *lista* de citas.
 -   **NUNCA llames a la herramienta sin la confirmación explícita del usuario.** Si el usuario solo está preguntando, responde como texto.
 
-❌ EJEMPLOS DE CONVERSACIONES FALLIDAS (EVITAR):
+"""
+
+# Ejemplos few-shot: solo en los primeros turnos de la conversación
+_SYSTEM_PROMPT_EXAMPLES = """❌ EJEMPLOS DE CONVERSACIONES FALLIDAS (EVITAR):
 
 **Falla 1: Agendar sin confirmación**
 Usuario: "Quiero hora para mañana a las 3"
-❌ Bot: {{..."action": "book_appointment"...}}
+❌ Bot: [llama a book_single_appointment]
 ✅ Bot: "¿Cuál es tu nombre completo?"
 
 **Falla 2: Suponer nombre completo**
 Usuario: "Juan"
-❌ Bot: {{..."name": "Juan"...}}
+❌ Bot: [llama a book_single_appointment con name="Juan"]
 ✅ Bot: "Hola Juan! ¿Cuál es tu apellido?"
 
 **Falla 3: No validar contacto**
 Usuario: "123"
-❌ Bot: {{..."contact": "123"...}}
+❌ Bot: [llama a book_single_appointment con contact="123"]
 ✅ Bot: "Necesito un teléfono válido (8+ dígitos) o un email 📱"
 
 ✅ EJEMPLOS DE CONVERSACIONES EXITOSAS:
@@ -563,12 +978,7 @@ Bot: "📋 Resumen de tu cita:
 
 ¿Confirmas para agendar?"
 Usuario: "Sí"
-Bot: {{"action": "book_appointment",  # Nota: Esto se cambia internamente por la herramienta
-  "name": "María González",
-  "contact": "912345678",
-  "date": "2024-03-20",
-  "time": "11:00"
-}}
+Bot: [llama a book_single_appointment con name="María González", contact="912345678", date="2024-03-20", time="11:00"]
 
 **Ejemplo 2: Usuario da toda la info junta**
 Usuario: "Soy Pedro Silva, mi teléfono es 987654321, quiero hora para el miércoles 20 a las 16:00"
@@ -583,12 +993,7 @@ Bot: "Perfecto Pedro!
 
 ¿Confirmas para agendar?"
 Usuario: "Dale"
-Bot: {{"action": "book_appointment",  # Nota: Esto se cambia internamente por la herramienta
-  "name": "Pedro Silva",
-  "contact": "987654321",
-  "date": "2024-03-20",
-  "time": "16:00"
-}}
+Bot: [llama a book_single_appointment con name="Pedro Silva", contact="987654321", date="2024-03-20", time="16:00"]
 
 **Ejemplo 3: Caso médico complejo**
 Usuario: "Hola, estoy embarazada y me duele mucho la espalda"
@@ -598,45 +1003,204 @@ Bot: "Hola! Por tu condición de embarazo, es importante que hables directamente
 Usuario: "Cuánto cuesta la consulta?"
 Bot: "La primera consulta cuesta $35.000 y las sesiones siguientes $40.000. ¿Quieres agendar una cita?"
 
-🔄 FECHA/HORA ACTUAL: {datetime.datetime.now(TZ).strftime('%Y-%m-%d %H:%M')}
+"""
 
-Ahora, responde al mensaje del usuario de forma natural y siguiendo todas estas reglas."""
+_SYSTEM_PROMPT_TAIL = """Ahora, responde al mensaje del usuario de forma natural y siguiendo todas estas reglas."""
 
+# Modelos construidos una sola vez al importar (thread-safe; la configuración no
+# cambia entre requests). Lo estático va como system_instruction
+# (con y sin ejemplos few-shot): el SDK lo arma una vez por modelo y cada request
+# solo envía la parte dinámica. Gemini 2.5 además cachea ese prefijo idéntico.
+_GEMINI_GENERATION_CONFIG = {
+    'temperature': 0.1,  
+    'top_p': 0.95,
+    'top_k': 40,
+    'max_output_tokens': 1024,
+}
+_GEMINI_MODEL = genai.GenerativeModel(
+    model_name='gemini-2.5-flash',  # Gemini 2.5 Flash experimental
+    generation_config=_GEMINI_GENERATION_CONFIG,
+    tools=[appointment_tools],
+    system_instruction=_SYSTEM_PROMPT_HEAD + _SYSTEM_PROMPT_RULES
+)
+_GEMINI_MODEL_WITH_EXAMPLES = genai.GenerativeModel(
+    model_name='gemini-2.5-flash',
+    generation_config=_GEMINI_GENERATION_CONFIG,
+    tools=[appointment_tools],
+    system_instruction=_SYSTEM_PROMPT_HEAD + _SYSTEM_PROMPT_RULES + _SYSTEM_PROMPT_EXAMPLES
+)
+
+HISTORY_DEFAULT_MESSAGES = 6  # mensajes de historial por defecto
+HISTORY_FULL_MESSAGES = 15  # si el último turno del bot fue un resumen de cita
+FEW_SHOT_MAX_BOT_REPLIES = 2  # ejemplos solo mientras el bot haya respondido menos veces
+
+# Caché de respuestas a primeros mensajes ("hola", "cuánto cuesta?"): sin historial,
+# contexto ni pendiente. El prompt igual incluye disponibilidad y fecha/hora, así
+# que solo se usan mensajes sin intención de agendar y respuestas sin horas ni fechas
+FAQ_CACHE_TTL = 5 * 60  # segundos
+FAQ_CACHE_MAX = 1000
+_FAQ_CACHE = OrderedDict()  # mensaje normalizado -> (expira, respuesta)
+_FAQ_CACHE_LOCK = threading.Lock()
+
+# Mensajes con intención de agendar (o cualquier dígito): su respuesta depende de
+# la disponibilidad, así que ni se buscan ni se guardan en la caché
+_FAQ_SCHEDULING_RE = re.compile(
+    r'\d|\b(hora|agend|cita|disponib|reserv|cupo|turno|hoy|mañana|semana|lunes|martes|'
+    r'mi[ée]rcoles|jueves|viernes|s[áa]bado|domingo)',
+    re.IGNORECASE
+)
+# Resguardo extra sobre la respuesta: horas, fechas, días, meses o "semana"
+_FAQ_VOLATILE_RE = re.compile(
+    r'\d{1,2}:\d{2}|\d{1,2}/\d{1,2}|\d{1,2}\s*(am|pm|hrs?|h)\b|'
+    r'\b(hoy|mañana|pasado|semana|lunes|martes|mi[ée]rcoles|jueves|viernes|s[áa]bado|domingo|'
+    r'enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|setiembre|octubre|noviembre|diciembre)\b',
+    re.IGNORECASE
+)
+
+def is_cacheable_faq_message(message):
+    """El mensaje no pide horas ni fechas: su respuesta no depende de la disponibilidad"""
+    return _FAQ_SCHEDULING_RE.search(message) is None
+
+def is_cacheable_faq_reply(response):
+    """Texto plano sin resumen por confirmar ni referencias a horas, fechas o días"""
+    return '¿Confirmas' not in response and _FAQ_VOLATILE_RE.search(response) is None
+
+def normalize_faq_key(message):
+    """Minúsculas, sin puntuación y con espacios colapsados"""
+    return ' '.join(_WORD_RE.findall(message.lower()))
+
+def get_cached_faq(key):
+    """Respuesta cacheada para el mensaje normalizado, o None"""
+    with _FAQ_CACHE_LOCK:
+        entry = _FAQ_CACHE.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del _FAQ_CACHE[key]
+            return None
+        _FAQ_CACHE.move_to_end(key)
+        return entry[1]
+
+def store_faq(key, response):
+    """Guarda la respuesta (LRU acotado a FAQ_CACHE_MAX)"""
+    with _FAQ_CACHE_LOCK:
+        _FAQ_CACHE[key] = (time.time() + FAQ_CACHE_TTL, response)
+        _FAQ_CACHE.move_to_end(key)
+        if len(_FAQ_CACHE) > FAQ_CACHE_MAX:
+            _FAQ_CACHE.popitem(last=False)
+
+def generate_first_part(model, prompt):
+    """
+    Genera en streaming: devuelve la llamada a herramienta (o el JSON de
+    agendamiento en texto) apenas llega; si no, un Part con el texto completo.
+    None si no hubo contenido.
+    """
+    text_chunks = []
+    for chunk in model.generate_content(prompt, stream=True):
+        if not chunk.candidates:
+            continue
+        for part in chunk.candidates[0].content.parts:
+            if part.function_call:
+                return part  # No hace falta esperar el resto del stream
+            if part.text:
+                text_chunks.append(part.text)
+                # JSON de agendamiento completo en texto: tampoco hace falta el resto
+                if '}' in part.text:
+                    text = ''.join(text_chunks)
+                    if _BOOK_JSON_RE.search(text):
+                        return genai.protos.Part(text=text)
+    
+    if not text_chunks:
+        return None
+    return genai.protos.Part(text=''.join(text_chunks))
+
+def generate_response(user_message, from_phone):
+    """
+    Genera respuesta usando Gemini 2.5 Flash con prompt optimizado
+    """
+    try:
+        # Un solo timestamp para todo el request
+        now = datetime.datetime.now(TZ)
         
-        model = genai.GenerativeModel(
-            model_name='gemini-2.5-flash',  # Gemini 2.5 Flash experimental
-            generation_config={
-                'temperature': 0.1,  
-                'top_p': 0.95,
-                'top_k': 40,
-                'max_output_tokens': 1024,
-            },
-            tools=[appointment_tools]  
+        # Candidato de la caché de FAQ (solo memoria): si hay acierto no se consulta
+        # Calendar, salvo que la BD muestre que no es un primer mensaje
+        faq_key = normalize_faq_key(user_message) if is_cacheable_faq_message(user_message) else None
+        cached_response = get_cached_faq(faq_key) if faq_key else None
+        
+        # La disponibilidad (Calendar, lo más lento) se consulta en paralelo
+        # mientras se leen historial, contexto y pendiente desde la BD
+        availability_future = None
+        if cached_response is None:
+            availability_future = _CALENDAR_EXECUTOR.submit(
+                get_available_slots_in_range, now, now + datetime.timedelta(days=7), now
+            )
+        
+        # Obtener contexto conversacional: historial corto salvo que haya un resumen
+        # de cita en curso, y ejemplos few-shot solo en los primeros turnos
+        messages = get_recent_messages(from_phone, limit=HISTORY_FULL_MESSAGES)
+        bot_replies = [content for direction, content in messages if direction != 'incoming']
+        if not (bot_replies and 'Resumen de tu cita' in bot_replies[-1]):
+            messages = messages[-HISTORY_DEFAULT_MESSAGES:]
+        history = format_history(messages)
+        model = _GEMINI_MODEL_WITH_EXAMPLES if len(bot_replies) < FEW_SHOT_MAX_BOT_REPLIES else _GEMINI_MODEL
+        # Contexto y pendiente llegan serializados desde la BD: van directo al prompt
+        context_json = get_conversation_context_json(from_phone)
+        
+        # Verificar si hay confirmación pendiente
+        pending_json = get_pending_confirmation_json(from_phone)
+        
+        # Detectar rechazos o preferencias en mensaje
+        if _PREFERENCES_RE.search(user_message):
+            context = json.loads(context_json) if context_json else {}
+            context['state'] = 'asking_preferences'  # Marca estado para que prompt sepa
+            context['user_preferences'] = user_message  # Guarda lo que dijo
+            context_json = update_conversation_state(from_phone, 'asking_preferences', context)
+        
+        # Primer mensaje sin estado: puede responderse desde la caché de FAQ
+        first_contact = not messages and not context_json and not pending_json
+        if cached_response and first_contact:
+            logger.info(f"Respuesta desde caché FAQ: {from_phone}")
+            return cached_response
+        if availability_future is None:
+            availability_future = _CALENDAR_EXECUTOR.submit(
+                get_available_slots_in_range, now, now + datetime.timedelta(days=7), now
+            )
+        
+        # Solo la parte dinámica se arma por request
+        availability_block = (
+            f"📊 DISPONIBILIDAD ACTUAL:\n"
+            f"- Próximos 7 días: {_json_dumps(availability_future.result())}\n"
+            "- Próximos 30 días: Resume disponibles (usa rangos para multi-sesiones, ej. 'Miércoles disponibles: 5/11, 12/11, 19/11, 26/11').\n"
+            "\n"
+            f"📝 HISTORIAL: {history}\n"
+            f"💾 CONTEXTO: {context_json or '{}'}\n"
+            f"⏳ PENDIENTE: {pending_json or 'null'}\n"
+            "\n"
         )
+        now_block = f"🔄 FECHA/HORA ACTUAL: {now.strftime('%Y-%m-%d %H:%M')}\n\n"
+        # Lo estático ya viaja como system_instruction del modelo
+        dynamic_prompt = "".join((availability_block, now_block, _SYSTEM_PROMPT_TAIL))
         
-        response = model.generate_content(
-            f"{system_prompt}\n\nMensaje del usuario:\n{user_message}"
+        bot_response_part = generate_first_part(
+            model, f"{dynamic_prompt}\n\nMensaje del usuario:\n{user_message}"
         )
         # Manejo de errores en respuesta
-        # En generate_response(), después de response = model.generate_content(...):
 
         max_retries = 3
         for attempt in range(max_retries):
-            if not response.candidates or not response.candidates[0].content.parts:
+            if bot_response_part is None:
                 logger.error(f"Intento {attempt+1}: Respuesta inválida. Reintentando con prompt simplificado.")
                 simplified_prompt = f"""
-                {system_prompt[:2000]}  # Trunca prompt original a essentials para evitar overload.
+                {dynamic_prompt[:2000]}  # Trunca prompt original a essentials para evitar overload.
                 \n\nHistorial reciente: {history[-500:]}  # Últimos 500 chars de history.
                 \n\nSimplifica: Ignora detalles complejos. Responde naturalmente a: {user_message}.
                 Si es agendamiento con horarios específicos, propone y pide confirmación.
                 """
-                response = model.generate_content(simplified_prompt)
+                bot_response_part = generate_first_part(model, simplified_prompt)
             else:
                 break  # Sal si es válida
-        if not response.candidates or not response.candidates[0].content.parts:
+        if bot_response_part is None:
             return "Disculpa, para tener claridad y no equivocarme. ¿Puedes decirme solo las fechas y horas que quieres?"
-        
-        bot_response_part = response.candidates[0].content.parts[0]
 
                 # Revisa si Gemini pidió llamar a una herramienta
         if hasattr(bot_response_part, 'function_call') and bot_response_part.function_call:
@@ -661,9 +1225,9 @@ Ahora, responde al mensaje del usuario de forma natural y siguiendo todas estas
                     }
                     
                     # Llama a tu función de agendamiento existente
-                    result = handle_appointment_booking(appointment_data)
+                    result = handle_appointment_booking(appointment_data, now=now)
                     clear_pending_confirmation(from_phone)
-                    return result
+                    return result['message']
                 
                 except Exception as e:
                     logger.error(f"Error procesando 'book_single_appointment': {e}")
@@ -690,14 +1254,12 @@ Ahora, responde al mensaje del usuario de forma natural y siguiendo todas estas
                             'time': appt.get('time'),
                             'phone': from_phone
                         }
-                        result = handle_appointment_booking(appointment_data)
-                        if "Error" in result or "❌" in result:  # Si falla una, aborta y retorna error.
-                            return result  # e.g., "Esa hora no está disponible."
+                        result = handle_appointment_booking(appointment_data, now=now)
+                        if not result['success']:  # Si falla una, aborta y retorna error.
+                            return result['message']  # e.g., "Esa hora no está disponible."
                         
-                        # Extrae fecha formateada de result (asumiendo result es como "✅ ¡Listo... 📅 05/11/2025 a las 16:00")
-                        date_match = re.search(r'📅 (\d{2}/\d{2}/\d{4}) a las (\d{2}:\d{2})', result)
-                        if date_match:
-                            booked_dates.append(f"• {date_match.group(1)} a las {date_match.group(2)}")
+                        # El resultado ya trae fecha y hora formateadas: no hace falta re-parsear el mensaje
+                        booked_dates.append(f"• {result['formatted_date']} a las {result['formatted_time']}")
                     
                     clear_pending_confirmation(from_phone)
                     
@@ -719,27 +1281,42 @@ Ahora, responde al mensaje del usuario de forma natural y siguiendo todas estas
         else:
             bot_response = bot_response_part.text.strip()
             
+            # Gemini a veces escribe el JSON de agendamiento como texto en vez de usar la herramienta;
+            # sin '{' (lo habitual) no se invoca el motor de regex
+            brace = bot_response.find('{')
+            book_match = _BOOK_JSON_RE.search(bot_response, brace) if brace != -1 else None
+            if book_match:
+                try:
+                    appointment_data = json.loads(book_match.group())
+                except json.JSONDecodeError:
+                    appointment_data = None
+                if appointment_data:
+                    appointment_data['phone'] = from_phone
+                    result = handle_appointment_booking(appointment_data, now=now)
+                    clear_pending_confirmation(from_phone)
+                    return result['message']
+            
             # Aquí puedes mantener tu lógica de 'pending_confirmation'
             if '¿Confirmas para agendar?' in bot_response or '¿Confirmas?' in bot_response:
                 # Extraer datos del resumen para guardar en pending_confirmations
                 try:
                     # Buscar datos en el resumen
-                    name_match = re.search(r'Nombre:\s*([^\n]+)', bot_response)
-                    date_match = re.search(r'Fecha:\s*([^\n]+)', bot_response)
-                    time_match = re.search(r'Hora:\s*(\d{1,2}:\d{2})', bot_response)
-                    contact_match = re.search(r'(?:Teléfono|Email):\s*([^\n]+)', bot_response)
+                    name_match = _NAME_RE.search(bot_response)
+                    date_match = _DATE_RE.search(bot_response)
+                    time_match = _TIME_RE.search(bot_response)
+                    contact_match = _CONTACT_RE.search(bot_response)
                     
                     if name_match and date_match and time_match and contact_match:
                         # Parsear fecha
                         date_text = date_match.group(1).strip()
                         # Intentar extraer fecha en formato DD/MM/YYYY
-                        date_number_match = re.search(r'(\d{2})/(\d{2})/(\d{4})', date_text)
+                        date_number_match = _DDMMYYYY_RE.search(date_text)
                         if date_number_match:
                             day, month, year = date_number_match.groups()
                             date_formatted = f"{year}-{month}-{day}"
                         else:
                             # Usar fecha sugerida del contexto o mañana por defecto
-                            date_formatted = (datetime.datetime.now(TZ) + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+                            date_formatted = (now + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
                         
                         pending_data = {
                             'name': name_match.group(1).strip(),
@@ -754,11 +1331,14 @@ Ahora, responde al mensaje del usuario de forma natural y siguiendo todas estas
                     logger.error(f"Error guardando confirmación pendiente: {e}")
             
             # Detectar confirmación del usuario
-            if pending and re.search(r'\b(s[ií]|confirmo|dale|ok|okay|correcto)\b', user_message.lower()):
+            if pending_json and is_confirmation(user_message):
                 # Usuario confirmó, procesar agendamiento
-                result = handle_appointment_booking(pending)
+                result = handle_appointment_booking(json.loads(pending_json), now=now)
                 clear_pending_confirmation(from_phone)
-                return result
+                return result['message']
+            
+            if faq_key and first_contact and is_cacheable_faq_reply(bot_response):
+                store_faq(faq_key, bot_response)
             
             return bot_response
         
@@ -778,118 +1358,207 @@ def send_whatsapp_message(to_phone, message):
     except Exception as e:
         logger.error(f"Error enviando mensaje: {str(e)}")
 
-def get_available_slots(date):
-    """Obtiene horarios disponibles para una fecha"""
-    try:
-        dt = date.replace(hour=0, minute=0, second=0, microsecond=0)
-        if dt.tzinfo is None:
-            dt = TZ.localize(dt)
-        
-        weekday = dt.weekday()
-        
-        # Cerrado lunes y domingos
-        if weekday == 0 or weekday == 6:
-            return []
-        
-        # Definir slots según día
-        if weekday in [1, 3]:  # Mar/Jue
-            slots = [(15, 0), (16, 0), (17, 0), (18, 0)]
-        elif weekday in [2, 4]:  # Mié/Vie
-            slots = [(10, 0), (11, 0), (12, 0), (13, 0), (14, 0), (15, 0), (16, 0), (17, 0)]
-        elif weekday == 5:  # Sáb
-            slots = [(10, 0), (11, 0), (12, 0)]
+# Cache corto de horarios por fecha: {fecha: (timestamp, slots)}
+SLOT_CACHE = {}  # 'YYYY-MM-DD' -> (guardado, slots libres, intervalos ocupados)
+SLOT_CACHE_TTL = 30  # segundos
+SLOT_CACHE_MAX = 64
+_SLOT_CACHE_LOCK = threading.Lock()
+
+def invalidate_slot_cache(date_str):
+    """Descarta los horarios cacheados de una fecha (YYYY-MM-DD)"""
+    with _SLOT_CACHE_LOCK:
+        SLOT_CACHE.pop(date_str, None)
+
+def _start_of_day(date):
+    """Medianoche (con zona horaria) del día de date"""
+    dt = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    if dt.tzinfo is None:
+        dt = TZ.localize(dt)
+    return dt
+
+def _get_cached_slots(date_str):
+    """Horarios cacheados de una fecha, o None si no hay o vencieron"""
+    with _SLOT_CACHE_LOCK:
+        entry = SLOT_CACHE.get(date_str)
+    if entry and time.time() - entry[0] < SLOT_CACHE_TTL:
+        return entry[1]
+    return None
+
+def get_cached_busy(date_str):
+    """Intervalos ocupados cacheados de una fecha, o None si no hay o vencieron"""
+    with _SLOT_CACHE_LOCK:
+        entry = SLOT_CACHE.get(date_str)
+    if entry and time.time() - entry[0] < SLOT_CACHE_TTL:
+        return entry[2]
+    return None
+
+def _store_slots(date_str, available, busy_ranges):
+    """Guarda los horarios de una fecha en SLOT_CACHE (FIFO acotado)"""
+    with _SLOT_CACHE_LOCK:
+        SLOT_CACHE.pop(date_str, None)
+        SLOT_CACHE[date_str] = (time.time(), available, busy_ranges)
+        if len(SLOT_CACHE) > SLOT_CACHE_MAX:
+            SLOT_CACHE.pop(next(iter(SLOT_CACHE)))
+
+def _working_window(dt, slots):
+    """(inicio, fin) de la jornada de atención del día dt"""
+    first_hour, first_minute, _ = slots[0]
+    last_hour, last_minute, _ = slots[-1]
+    return (
+        dt.replace(hour=first_hour, minute=first_minute),
+        dt.replace(hour=last_hour, minute=last_minute) + APPOINTMENT_DURATION
+    )
+
+def _free_slots(dt, slots, busy_ranges, now_ts):
+    """Etiquetas de los slots del día dt que son futuros y no chocan con busy_ranges"""
+    available = []
+    for hour, minute, label in slots:
+        slot_start = dt.replace(hour=hour, minute=minute).timestamp()
+        slot_end = slot_start + APPOINTMENT_SECONDS
         
-        available = []
-        for hour, minute in slots:
-            slot_dt = dt.replace(hour=hour, minute=minute)
-            end_dt = slot_dt + datetime.timedelta(hours=1)
-            
-            if slot_dt > datetime.datetime.now(TZ) and not check_freebusy(slot_dt, end_dt):
-                available.append(f"{hour:02d}:{minute:02d}")
+        if slot_start > now_ts and is_range_free(busy_ranges, slot_start, slot_end):
+            available.append(label)
+    return available
+
+# La consulta de disponibilidad corre aquí, en paralelo con las lecturas de BD
+_CALENDAR_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='calendar')
+
+def get_available_slots_in_range(start_date, end_date, now=None):
+    """Obtiene slots disponibles en un rango de fechas con una sola consulta
+    freebusy para todos los días que no estén en SLOT_CACHE"""
+    available = {}
+    missing = []  # (día, date_str, slots) de días abiertos sin caché
+    day = start_date
+    while day <= end_date:
+        dt = _start_of_day(day)
+        date_str = dt.strftime('%Y-%m-%d')
+        slots = SLOTS_BY_WEEKDAY.get(dt.weekday())
+        cached = _get_cached_slots(date_str) if slots else None
+        if cached:
+            available[date_str] = cached
+        elif slots and cached is None:
+            missing.append((dt, date_str, slots))
+        day += datetime.timedelta(days=1)
+    
+    if missing:
+        try:
+            busy_ranges = get_busy_intervals(
+                _working_window(missing[0][0], missing[0][2])[0],
+                _working_window(missing[-1][0], missing[-1][2])[1]
+            )
+        except Exception as e:
+            logger.error(f"Error obteniendo slots: {e}")
+            busy_ranges = None
         
-        return available
-    except Exception as e:
-        logger.error(f"Error obteniendo slots: {e}")
-        return None
+        if busy_ranges is not None:
+            now_ts = (now or datetime.datetime.now(TZ)).timestamp()
+            for dt, date_str, slots in missing:
+                slots_free = _free_slots(dt, slots, busy_ranges, now_ts)
+                _store_slots(date_str, slots_free, busy_ranges)
+                if slots_free:
+                    available[date_str] = slots_free
     
-def get_available_slots_in_range(start_date, end_date):
-    """Obtiene slots disponibles en un rango de fechas"""
-    current = start_date
-    available = {}
-    while current <= end_date:
-        slots = get_available_slots(current)
-        if slots:
-            available[current.strftime('%Y-%m-%d')] = slots
-        current += datetime.timedelta(days=1)
-    return available
+    # Mismo orden cronológico que antes, con días cacheados y recién consultados
+    return dict(sorted(available.items()))
+
+@lru_cache(maxsize=256)
+def parse_appointment_datetime(date_str, time_str):
+    """Normaliza fecha y hora tal como las escribe el LLM a un datetime con zona
+    horaria; devuelve (dt, None) o (None, mensaje de error). Cacheada porque en
+    los turnos de confirmación se repiten los mismos valores"""
+    # Improved time parsing with am/pm handling
+    time_str = time_str.lower().translate(_TIME_FIX)
+    is_pm = 'pm' in time_str
+    is_am = 'am' in time_str
+    time_str = time_str.replace('am', '').replace('pm', '')
+    
+    if ':' not in time_str and len(time_str) <= 2:
+        time_str = f"{time_str}:00"
+    
+    # Parse hour and minute
+    try:
+        hour, minute = map(int, time_str.split(':'))
+    except ValueError:
+        return None, "Error en hora. Usa HH:MM o con am/pm"
+    
+    # Handle am/pm conversion to 24h
+    if is_am and hour == 12:
+        hour = 0
+    elif is_pm and hour != 12:
+        hour += 12
+    
+    # YYYY-MM-DD, o DD-MM-YYYY / DD/MM/YYYY
+    parts = date_str.replace('/', '-').split('-')
+    if len(parts) == 3 and len(parts[0]) == 2:
+        parts.reverse()
+    
+    # Construcción directa: evita el costo de strptime
+    try:
+        year, month, day = map(int, parts)
+        dt = datetime.datetime(year, month, day, hour, minute)
+    except ValueError:
+        return None, "Error en fecha/hora. Usa: YYYY-MM-DD y HH:MM"
+    
+    return TZ.localize(dt), None
+
+def parse_and_validate(date_str, time_str, now=None):
+    """Parsea y valida fecha/hora de una cita sin usar excepciones para los casos
+    normales; devuelve (None, dt, end_dt) o (mensaje de error, None, None)"""
+    if not date_str or not time_str:
+        return "Error en fecha/hora. Usa: YYYY-MM-DD y HH:MM", None, None
+    
+    dt, error = parse_appointment_datetime(date_str, time_str)
+    if error:
+        return error, None, None
+    
+    error = validate_business_hours(dt, now=now)
+    if error:
+        return error, None, None
+    
+    return None, dt, dt + APPOINTMENT_DURATION
 
-def handle_appointment_booking(data):
+def handle_appointment_booking(data, now=None):
     try:
         name = data.get('name')
         contact = data.get('contact')
         date_str = data.get('date')
         time_str = data.get('time')
         
-        if len(name.split()) < 2:
+        # Campos faltantes se responden explícitamente, no vía excepción
+        if not name or len(name.split()) < 2:
             return {'success': False, 'message': "Por favor, dame tu nombre y apellido completo 😊"}
         
-        contact_clean = contact.replace('+', '').replace(' ', '').replace('-', '')
+        if not contact:
+            return {'success': False, 'message': "Necesito un teléfono válido (8+ dígitos) o un email 📱"}
+        contact_clean = contact.translate(_STRIP_CONTACT)
         is_phone = contact_clean.isdigit() and len(contact_clean) >= 8
-        is_email = re.match(r'^[\w\.-]+@[\w\.-]+\.\w+$', contact) is not None
+        is_email = _EMAIL_RE.match(contact) is not None
         
         if not (is_phone or is_email):
             return {'success': False, 'message': "Necesito un teléfono válido (8+ dígitos) o un email 📱"}
         
         logger.info(f"Agendando: {name} | {contact} | {date_str} | {time_str}")
         
-        # Improved time parsing with am/pm handling
-        time_str = time_str.lower().replace('.', ':').replace(' ', '')
-        is_pm = 'pm' in time_str
-        is_am = 'am' in time_str
-        time_str = time_str.replace('am', '').replace('pm', '')
-        
-        if ':' not in time_str and len(time_str) <= 2:
-            time_str = f"{time_str}:00"
-        
-        # Parse hour and minute
-        try:
-            hour, minute = map(int, time_str.split(':'))
-        except ValueError:
-            return {'success': False, 'message': "Error en hora. Usa HH:MM o con am/pm"}
-        
-        # Handle am/pm conversion to 24h
-        if is_am and hour == 12:
-            hour = 0
-        elif is_pm and hour != 12:
-            hour += 12
-        elif is_pm and hour == 12:
-            hour = 12  # 12 pm is 12:00
-        time_str = f"{hour:02d}:{minute:02d}"
-        
-        date_str = date_str.replace('/', '-')
-        if date_str.count('-') == 2:
-            parts = date_str.split('-')
-            if len(parts[0]) == 2:
-                date_str = f"{parts[2]}-{parts[1]}-{parts[0]}"
-        
-        try:
-            dt = datetime.datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
-        except ValueError:
-            return {'success': False, 'message': "Error en fecha/hora. Usa: YYYY-MM-DD y HH:MM"}
-        
-        dt = TZ.localize(dt)
-        end_dt = dt + datetime.timedelta(hours=1)
-        
-        error = validate_business_hours(dt)
+        error, dt, end_dt = parse_and_validate(date_str, time_str, now=now)
         if error:
             return {'success': False, 'message': error}
+        date_str = dt.strftime('%Y-%m-%d')
+        time_str = dt.strftime('%H:%M')
+        
+        # Negativo rápido: si los ocupados cacheados del día ya chocan, no hace
+        # falta ir a Calendar; un positivo siempre se confirma en vivo
+        busy_ranges = get_cached_busy(date_str)
+        if busy_ranges is not None and not is_range_free(busy_ranges, dt.timestamp(), end_dt.timestamp()):
+            return {'success': False, 'message': f"❌ {date_str} a las {time_str} ya está ocupado.\n¿Otro horario?"}
         
         if check_freebusy(dt, end_dt):
+            # El calendario cambió por fuera: los horarios cacheados de ese día quedaron viejos
+            invalidate_slot_cache(date_str)
             return {'success': False, 'message': f"❌ {date_str} a las {time_str} ya está ocupado.\n¿Otro horario?"}
         
-        # Crea cita y guarda en BD
+        # Crea cita en Calendar (síncrono: confirma el horario) y la registra en BD en segundo plano
         event_id = create_appointment(name, contact, dt)
-        save_appointment(data.get('phone', 'unknown'), name, contact, dt, event_id)
+        save_appointment_async(data.get('phone', 'unknown'), name, contact, dt, event_id)
         
         fecha_formato = dt.strftime("%d/%m/%Y")
         formatted_time = time_str
@@ -907,43 +1576,50 @@ def handle_appointment_booking(data):
         logger.error(f"Error agendando: {str(e)}", exc_info=True)
         return {'success': False, 'message': "Error al agendar. Llámanos: +56 9 7533 2088"}
 
-def validate_business_hours(dt):
+def validate_business_hours(dt, now=None):
     """Valida horarios de negocio"""
-    weekday = dt.weekday()
-    hour = dt.hour
-    
-    now = datetime.datetime.now(TZ)
+    if now is None:
+        now = datetime.datetime.now(TZ)
     if dt < now:
         return "❌ Esa fecha/hora ya pasó"
     
-    if weekday == 0:
-        return "❌ Cerrados los lunes"
-    elif weekday == 6:
-        return "❌ Cerrados los domingos"
-    elif weekday in [1, 3]:
-        if not (15 <= hour < 19):
-            return "❌ Mar/Jue atendemos 15:00-19:00"
-    elif weekday in [2, 4]:
-        if not (10 <= hour < 18):
-            return "❌ Mié/Vie atendemos 10:00-18:00"
-    elif weekday == 5:
-        if not (10 <= hour < 13):
-            return "❌ Sábados 10:00-13:00"
-    
-    return None
+    return _HOURS_ERRORS[(dt.weekday(), dt.hour)]
+
+def get_busy_intervals(start_dt, end_dt):
+    """Obtiene los intervalos ocupados del calendario como (inicio_ts, fin_ts), en una sola consulta"""
+    body = {
+        "timeMin": start_dt.isoformat(),
+        "timeMax": end_dt.isoformat(),
+        "items": [{"id": CALENDAR_ID}]
+    }
+    response = CALENDAR_SERVICE.freebusy().query(body=body).execute(http=get_calendar_http())
+    busy = response['calendars'][CALENDAR_ID].get('busy', [])
+    return merge_busy_intervals(
+        (datetime.datetime.fromisoformat(b['start']).timestamp(),
+         datetime.datetime.fromisoformat(b['end']).timestamp())
+        for b in busy
+    )
+
+def merge_busy_intervals(intervals):
+    """Ordena y fusiona intervalos (inicio, fin) solapados"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def is_range_free(busy_ranges, start_ts, end_ts):
+    """Indica si [start_ts, end_ts) no choca con intervalos ordenados y fusionados"""
+    # Solo el último intervalo que empieza antes de end_ts puede solaparse
+    i = bisect.bisect_left(busy_ranges, (end_ts,))
+    return i == 0 or busy_ranges[i - 1][1] <= start_ts
 
 def check_freebusy(start_dt, end_dt):
     """Verifica disponibilidad en calendario"""
     try:
-        service = build('calendar', 'v3', credentials=credentials)
-        body = {
-            "timeMin": start_dt.isoformat(),
-            "timeMax": end_dt.isoformat(),
-            "items": [{"id": CALENDAR_ID}]
-        }
-        response = service.freebusy().query(body=body).execute()
-        busy = response['calendars'][CALENDAR_ID].get('busy', [])
-        return len(busy) > 0
+        return len(get_busy_intervals(start_dt, end_dt)) > 0
     except Exception as e:
         logger.error(f"Error calendario: {str(e)}")
         return False
@@ -951,8 +1627,7 @@ def check_freebusy(start_dt, end_dt):
 def create_appointment(name, contact, dt):
     """Crea evento en Google Calendar"""
     try:
-        service = build('calendar', 'v3', credentials=credentials)
-        end_dt = dt + datetime.timedelta(hours=1)
+        end_dt = dt + APPOINTMENT_DURATION
         
         event = {
             'summary': f'Cita: {name}',
@@ -974,7 +1649,10 @@ def create_appointment(name, contact, dt):
             }
         }
         
-        result = service.events().insert(calendarId=CALENDAR_ID, body=event).execute()
+        result = CALENDAR_SERVICE.events().insert(
+            calendarId=CALENDAR_ID, body=event
+        ).execute(http=get_calendar_http())
+        invalidate_slot_cache(dt.strftime('%Y-%m-%d'))
         logger.info(f"✓ Cita creada: {name} - {dt.strftime('%Y-%m-%d %H:%M')}")
         return result.get('id')
         
@@ -1015,23 +1693,12 @@ def whatsapp_webhook():
         logger.info(f"→ [Validado] Mensaje de (***ANONIMO): [MENSAJE RECIBIDO]")
     # --- FIN DE LOG ANÓNIMO ---
     
-    cleanup_old_sessions()
-    
-    session = MESSAGE_BUFFER[from_phone]
+    session = touch_session(from_phone)
     
     with session['lock']:
         session['messages'].append(incoming_msg)
-        session['last_activity'] = time.time()
-        
-        if session['timer']:
-            session['timer'].cancel()
-        
-        session['timer'] = threading.Timer(
-            BUFFER_DELAY,
-            process_buffered_messages,
-            args=[from_phone]
-        )
-        session['timer'].start()
+    
+    schedule_buffer_flush(from_phone, session)
     
     return '', 200
 
@@ -1053,14 +1720,9 @@ def stats():
         with get_db() as conn:
             cursor = conn.cursor()
             
-            cursor.execute('SELECT COUNT(*) FROM conversations WHERE client_id = %s', (CLIENT_ID,))
-            total_conversations = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM messages WHERE client_id = %s', (CLIENT_ID,))
-            total_messages = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM appointments WHERE client_id = %s', (CLIENT_ID,))
-            total_appointments = cursor.fetchone()[0]
+            # Los tres conteos en un solo round-trip
+            cursor.execute(_SQL_STATS, {'client_id': CLIENT_ID})
+            total_conversations, total_messages, total_appointments = cursor.fetchone()
             
             return {
                 'total_conversations': total_conversations,